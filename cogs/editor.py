@@ -6,21 +6,28 @@ image obtained by the user using the Query cog.
 
 # Standard library imports
 import io
-from enum import Enum
 import copy 
 # Discord and discord extensions library imports
 import discord
 from discord.ext import commands
 # PIL (Pillow) image editing library import
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+# Local module imports
+import effects
+import textrender
+from sessions import WhiteSpace
 
+# Interactive edits are previewed at this max width/height and JPEG
+# quality. !export renders the full resolution image.
+PREVIEW_SIZE = 512
+PREVIEW_QUALITY = 70
+# The maximum number of effects that can be chained.
+MAX_EFFECTS = 8
 
-class WhiteSpace(Enum):
-    """Enum describing the various whitespace states."""
-    TOP = 1
-    BOT = 2
-    TOPBOT = 3
-    NONE = 4
+
+class NoImageSelected(commands.CheckFailure):
+    """Raised by the Editor cog check when no image is selected."""
+    pass
 
 
 class Editor(commands.Cog):
@@ -33,34 +40,33 @@ class Editor(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        query_instance = bot.get_cog('Query')
-        if query_instance is not None: 
-            self.original_image_bytes = query_instance.get_selected_image()
-            #bot.unload_extension(f'cogs.query')
-        
-        self.new_image_binary = None
         self.image_object_edit_history = None
 
-        self.top_text = ""
-        self.bottom_text = ""
-        self.align_type = 'center'
-        self.font_type = 'impact'
-        self.text_size = 42
-        self.text_color = 'white'
-        self.text_outline_color = 'black'
-        self.text_ouline_size = 2
-
-        self.whitespace = WhiteSpace.NONE
-        self.whitespace_ratio = 0.25
-
     async def cog_check(self, ctx):
         """Cog level context checker.
         
         Is called and evaluated whenever a command is mentioned.
-        Checks whether the command has been used in a dm channel.
+        Checks whether the command has been used in a dm channel and
+        whether the user has selected an image to edit.
+
+        Checks have no side effects, as the help command runs them for
+        every command it lists. The reply for a missing image is sent
+        by cog_command_error.
         """
-        if isinstance(ctx.channel, discord.DMChannel): return True
-        else: return False
+        if not isinstance(ctx.channel, discord.DMChannel): return False
+        session = await self.bot.get_cog('Sessions').get(ctx.author.id)
+        if session.selected_image is None:
+            raise NoImageSelected()
+        return True
+
+    async def cog_command_error(self, ctx, error):
+        """Tells the user to select an image when the check failed."""
+        if isinstance(error, NoImageSelected):
+            await ctx.send("You need to select an image before you can edit it.")
+
+    async def cog_before_invoke(self, ctx):
+        """Attaches the session of the user to the context."""
+        ctx.session = await self.bot.get_cog('Sessions').get(ctx.author.id)
     
     @commands.group(name='caption', invoke_without_command=True)
     async def add_caption(self, ctx):
@@ -72,8 +78,8 @@ class Editor(commands.Cog):
         "changed the default formatting will be used.")
     async def add_caption_top(self, ctx, *, arg):
         if len(arg) < 100:
-            self.top_text = arg
-            await self.edit_image()
+            ctx.session.top_text = arg
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
         else:
             await ctx.send("The text you entered was too long. The bot"
@@ -85,8 +91,8 @@ class Editor(commands.Cog):
         "changed the default formatting will be used.")
     async def add_caption_bottom(self, ctx, *, arg):
         if len(arg) < 100:
-            self.bottom_text = arg
-            await self.edit_image()
+            ctx.session.bottom_text = arg
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
         else:
             await ctx.send("The text you entered was too long. The bot has a limit of 100 characters for captions.")
@@ -105,16 +111,16 @@ class Editor(commands.Cog):
             return
         elif len(ratio) == 1:
             if ratio[0] <= 1:
-                self.whitespace_ratio = ratio[0] 
+                ctx.session.whitespace_ratio = ratio[0] 
                 await ctx.send("Whitespace ratio set to " + str(ratio[0]))
             else:
                 await ctx.send("Incorrect parameter. Please try again.")
                 return
-        if self.whitespace == WhiteSpace.NONE:
-            self.whitespace = WhiteSpace.TOP
-        elif self.whitespace == WhiteSpace.BOT:
-            self.whitespace = WhiteSpace.TOPBOT 
-        await self.edit_image()
+        if ctx.session.whitespace == WhiteSpace.NONE:
+            ctx.session.whitespace = WhiteSpace.TOP
+        elif ctx.session.whitespace == WhiteSpace.BOT:
+            ctx.session.whitespace = WhiteSpace.TOPBOT 
+        await self.edit_image(ctx.session)
         await self.show_modified_image(ctx)
     
     @add_whitespace.command(name='bot',
@@ -128,16 +134,16 @@ class Editor(commands.Cog):
             return
         elif len(ratio) == 1:
             if ratio[0] <= 1:
-                self.whitespace_ratio = ratio[0] 
+                ctx.session.whitespace_ratio = ratio[0] 
                 await ctx.send("Whitespace ratio set to " + str(ratio[0]))
             else:
                 await ctx.send("Incorrect parameter. Please try again.")
                 return
-        if self.whitespace == WhiteSpace.NONE:
-            self.whitespace = WhiteSpace.BOT
-        elif self.whitespace == WhiteSpace.TOP:
-            self.whitespace = WhiteSpace.TOPBOT 
-        await self.edit_image()
+        if ctx.session.whitespace == WhiteSpace.NONE:
+            ctx.session.whitespace = WhiteSpace.BOT
+        elif ctx.session.whitespace == WhiteSpace.TOP:
+            ctx.session.whitespace = WhiteSpace.TOPBOT 
+        await self.edit_image(ctx.session)
         await self.show_modified_image(ctx) 
     
     @commands.group(name='text', invoke_without_command=True)
@@ -151,8 +157,8 @@ class Editor(commands.Cog):
     async def change_text_font(self, ctx, arg: str):
         accepted_fonts = ['impact', 'arial']
         if arg in accepted_fonts:
-            self.font_type = arg
-            await self.edit_image()
+            ctx.session.font_type = arg
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
         else:
             ctx.send("Unrecognized font type. Please try again.")
@@ -162,9 +168,9 @@ class Editor(commands.Cog):
                         The default size is 42. The max size is 60.""")
     async def change_text_size(self, ctx, size: int):
         if size <= 60:
-            self.text_size = size
-            await ctx.send("Text size changed to " + str(self.text_size) + ".")
-            await self.edit_image()
+            ctx.session.text_size = size
+            await ctx.send("Text size changed to " + str(ctx.session.text_size) + ".")
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
     
     @change_text.command(name='color',
@@ -173,9 +179,9 @@ class Editor(commands.Cog):
     async def change_text_color(self, ctx, arg: str):
         accepted_colors = ['white', 'black', 'red', 'green', 'blue', 'orange', 'purple']
         if arg in accepted_colors:
-            self.text_color = arg
+            ctx.session.text_color = arg
             await ctx.send("Text color changed to " + arg + ".")
-            await self.edit_image()
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
         else:
             await ctx.send("Invalid color enter. Use the !show colors "
@@ -189,9 +195,9 @@ class Editor(commands.Cog):
     async def change_text_outline_color(self, ctx, arg: str):
         accepted_colors = ['white', 'black', 'red', 'green', 'blue', 'orange', 'purple']
         if arg in accepted_colors:
-            self.text_color = arg
+            ctx.session.text_color = arg
             await ctx.send("Text color changed to " + arg + ".")
-            await self.edit_image()
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
         else:
             await ctx.send("Invalid color name entered. Use the !show " 
@@ -202,8 +208,8 @@ class Editor(commands.Cog):
         The default value is 2. The max value is 10""")
     async def change_text_outline_size(self, ctx, size: int):
         if size <= 10:
-            self.text_ouline_size = size
-            await self.edit_image()
+            ctx.session.text_ouline_size = size
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
         else:
             await ctx.send("Invalid size value entered. The maximum value you can enter is 10.")
@@ -212,12 +218,90 @@ class Editor(commands.Cog):
     async def change_text_align_type(self, ctx, arg):
         align_type_list = ['left', 'center', 'right']
         if arg in align_type_list:
-            self.align_type = arg
-            await self.edit_image()
+            ctx.session.align_type = arg
+            await self.edit_image(ctx.session)
             await self.show_modified_image(ctx)
         else:
             await ctx.send("Incorrect parameter. Text can be aligned left, center, or right.")
     
+    @change_text.command(name='renderer',
+        help="Command used to change the text renderer. 'stroke' (the"
+        " default) uses the original outline stroking. 'mask' draws cached"
+        " caption masks, which is faster when the same caption is redrawn"
+        " (e.g. while changing colors or whitespace) but slower the first"
+        " time a caption or size is drawn, including !export."
+        " Example: !text renderer mask")
+    async def change_text_renderer(self, ctx, arg):
+        if arg in textrender.RENDERERS:
+            ctx.session.text_renderer = arg
+            await self.edit_image(ctx.session)
+            await self.show_modified_image(ctx)
+        else:
+            await ctx.send("Incorrect parameter. The available renderers are "
+            + ", ".join(textrender.RENDERERS) + ".")
+
+    @commands.group(name='effect', invoke_without_command=True,
+        help="Command used to apply an effect to the image. Effects are"
+        " chained in the order they are added and are applied before the"
+        " whitespace and captions. An optional value changes the effect"
+        " strength and is clamped to the allowed values of the effect."
+        " Example: !effect deepfry 1.5. Use !effect list to see the"
+        " available effects and !effect clear to remove them.")
+    async def add_effect(self, ctx, name: str, *value: float):
+        if name not in effects.EFFECTS or len(value) > 1:
+            await ctx.send("Incorrect parameter. Use !effect list to get a "
+            "list of the available effects.")
+            return
+        if len(ctx.session.effects) >= MAX_EFFECTS:
+            await ctx.send("You can chain up to " + str(MAX_EFFECTS) + 
+            " effects. Use !effect clear to remove them.")
+            return
+        parameter = value[0] if value else effects.EFFECTS[name][1]
+        try:
+            parameter = effects.check_parameter(name, parameter)
+        except ValueError:
+            await ctx.send("Incorrect parameter. The value needs to be a "
+            "number. Use !effect list to see the allowed values.")
+            return
+        # The effect is only kept if the image renders with it
+        previous_effects = ctx.session.effects
+        ctx.session.effects = previous_effects + ((name, parameter),)
+        try:
+            await self.edit_image(ctx.session)
+        except Exception:
+            ctx.session.effects = previous_effects
+            raise
+        await self.show_modified_image(ctx)
+
+    @add_effect.command(name='list',
+        help="Command used to list the available effects.")
+    async def list_effects(self, ctx):
+        await ctx.send("Available effects (default value, allowed values): "
+            + ", ".join(
+            name + " (" + str(default) + ", " + str(minimum) + " to "
+            + str(maximum) + ")"
+            for name, (_, default, minimum, maximum)
+            in effects.EFFECTS.items()) + ".")
+
+    @add_effect.command(name='clear',
+        help="Command used to remove all effects from the image.")
+    async def clear_effects(self, ctx):
+        ctx.session.effects = ()
+        await self.edit_image(ctx.session)
+        await self.show_modified_image(ctx)
+
+    @commands.command(name='export',
+        help="Command used to render the final image at full resolution "
+        "and best quality. The editing commands only send previews.")
+    async def export(self, ctx):
+        await self.edit_image(ctx.session, preview=False)
+        ctx.session.new_image_binary.seek(0)
+        await ctx.send(
+            file=discord.File(
+                ctx.session.new_image_binary,
+                'meme.jpg')
+        )
+
     @commands.command()
     async def undo(self):
         pass
@@ -228,43 +312,44 @@ class Editor(commands.Cog):
     
     @commands.group(invoke_without_command=True)
     async def reset(self, ctx):
-        self.top_text = ""
-        self.bottom_text = ""
-
-        self.align_type = 'center'
-        self.font_type = 'arial'
-        self.text_size = 42
-        self.text_color = 'white'
-        self.text_outline_color = 'black'
-        self.text_ouline_size = 2
+        ctx.session.top_text = ""
+        ctx.session.bottom_text = ""
+
+        ctx.session.align_type = 'center'
+        ctx.session.font_type = 'arial'
+        ctx.session.text_size = 42
+        ctx.session.text_color = 'white'
+        ctx.session.text_outline_color = 'black'
+        ctx.session.text_ouline_size = 2
         
-        self.whitespace = WhiteSpace.NONE
-        self.whitespace_ratio = 0.25
+        ctx.session.whitespace = WhiteSpace.NONE
+        ctx.session.whitespace_ratio = 0.25
+        ctx.session.effects = ()
         
-        self.new_image_binary = None
+        ctx.session.new_image_binary = None
     
     @reset.command(name='text')
     async def reset_text(self, ctx):
-        self.top_text = ""
-        self.bottom_text = ""
+        ctx.session.top_text = ""
+        ctx.session.bottom_text = ""
 
     @reset.command(name='font')
     async def reset_font(self, ctx):
-        self.align_type = 'center'
-        self.font_type = 'impact'
-        self.text_size = 42
-        self.text_color = 'white'
-        self.text_outline_color = 'black'
-        self.text_ouline_size = 2
+        ctx.session.align_type = 'center'
+        ctx.session.font_type = 'impact'
+        ctx.session.text_size = 42
+        ctx.session.text_color = 'white'
+        ctx.session.text_outline_color = 'black'
+        ctx.session.text_ouline_size = 2
     
     @reset.command(name='whitespace')
     async def reset_whitespace(self, ctx):
-        self.whitespace = WhiteSpace.NONE
-        self.whitespace_ratio = 0.25
+        ctx.session.whitespace = WhiteSpace.NONE
+        ctx.session.whitespace_ratio = 0.25
     
     @reset.command()
     async def image(self,ctx):
-        self.new_image_binary = None
+        ctx.session.new_image_binary = None
     
     @commands.group(invoke_without_command=True)
     async def show_image(self, ctx):
@@ -272,42 +357,44 @@ class Editor(commands.Cog):
     
     @show_image.command(name='original')
     async def show_original_image(self, ctx):
-        self.original_image_bytes.seek(0)
+        ctx.session.selected_image.seek(0)
         await ctx.send(
             file=discord.File(
-                self.original_image_bytes, 
+                ctx.session.selected_image, 
                 'original_image.jpg')
         )
 
     @show_image.command(name='new')
     async def show_modified_image(self, ctx):
-        if self.new_image_binary is not None:
-            self.new_image_binary.seek(0)
+        if ctx.session.new_image_binary is not None:
+            ctx.session.new_image_binary.seek(0)
             await ctx.send(
                 file=discord.File(
-                    self.new_image_binary, 
+                    ctx.session.new_image_binary, 
                     'new_image.jpg')
             )
         else:
             await ctx.send("The image has not been modified. Use !show original to display the image.")
     
-    async def edit_image(self):
+    async def edit_image(self, session, preview=True):
         """Function used to edit the images. 
         
-        Takes the original image and applies edits according to the 
-        parameters defined by class attributes.
+        Takes the selected image and applies edits according to the 
+        settings stored in the session of the user. Previews are rendered
+        at a bounded size with cheap encode settings, the export render
+        (preview=False) at full resolution and best quality.
         """
 
         def add_whitespace_func() -> Image:
             """ Adds a whitespace to the the image object """
             
             new_image_layer = None
-            whitespace_height = int(img.height * self.whitespace_ratio)
-            if self.whitespace == WhiteSpace.TOPBOT:
+            whitespace_height = int(img.height * session.whitespace_ratio)
+            if session.whitespace == WhiteSpace.TOPBOT:
                 new_image_size = (img.width, img.height + 2 * whitespace_height)
                 new_image_layer = Image.new('RGB', new_image_size, (255,255,255))
                 new_image_layer.paste(img, (0, whitespace_height))
-            elif self.whitespace == WhiteSpace.BOT:
+            elif session.whitespace == WhiteSpace.BOT:
                 new_image_size = (img.width, img.height + whitespace_height)
                 new_image_layer = Image.new('RGB', new_image_size, (255,255,255))
                 new_image_layer.paste(img, (0, 0))
@@ -317,7 +404,21 @@ class Editor(commands.Cog):
                 new_image_layer.paste(img, (0, whitespace_height))
             return new_image_layer
 
-        def drawText(text, pos):
+        def layoutText(text, pos) -> tuple:
+            """Lays out the caption on the full resolution image.
+
+            Returns the caption with line breaks inserted and its
+            position. The result only depends on the text settings and
+            the full resolution image size, so it is cached and reused
+            by both the preview and the export render.
+            """
+
+            def textSize(text) -> tuple:
+                """Measures text, taking fallback fonts into account."""
+                if textrender.needs_fallback(text, session.font_type):
+                    return textrender.text_size(
+                        text, session.font_type, session.text_size)
+                return draw.textsize(text, font)
 
             def findTextSlices(text) -> list:
                 """Slices text into managable chunks at the spaces b/w words."""
@@ -329,8 +430,8 @@ class Editor(commands.Cog):
                 for word in wordsInText:
                     # Then it is recreated by adding each word one by one 
                     # (draw returns a tuple of length 2) 
-                    widthOfUpdatedSlice = draw.textsize((' '.join(list)) + word, font)[0]
-                    if  widthOfUpdatedSlice < img.width:
+                    widthOfUpdatedSlice = textSize((' '.join(list)) + word)[0]
+                    if  widthOfUpdatedSlice < layout_width:
                         # If this recreated text does not go over image width
                         # add it to the current slice
                         list.append(word)
@@ -343,21 +444,18 @@ class Editor(commands.Cog):
                         list.append(word)
                 sliceList.append(list)
                 return sliceList
-            
-            def drawTextWithOutline(text, x, y):
 
-                draw.multiline_text(
-                    (x, y), text, self.text_color, font=font, 
-                    align=self.align_type, stroke_width=self.text_ouline_size, 
-                    stroke_fill='black'
-                )
-                return
+            layout_key = (text, session.font_type, session.text_size,
+                          layout_width, layout_height)
+            cached_layout = session.caption_layouts.get(pos)
+            if cached_layout is not None and cached_layout[0] == layout_key:
+                return cached_layout[1]
 
-            w, h = draw.textsize(text, font)
+            w, h = textSize(text)
 
             # If the given text does not fit in the width of the image
             textList = []
-            if w > img.width:
+            if w > layout_width:
                 #Find the slices of the text
                 textList.extend(findTextSlices(text))
                 
@@ -366,7 +464,7 @@ class Editor(commands.Cog):
             
             lastY = -h
             if pos == "b":
-                lastY = img.height - h * (len(textList) + 1) - 10
+                lastY = layout_height - h * (len(textList) + 1) - 10
             
             textSlice = []
             text_multiline = None
@@ -380,33 +478,84 @@ class Editor(commands.Cog):
             
             if text_multiline is None: 
                 text_multiline = '\n'.join(textSlice)
-            w, h = draw.textsize(text_multiline, font)
-            x = img.width/2 - w/2
+            w, h = textSize(text_multiline)
+            x = layout_width/2 - w/2
             y = lastY + h
-            drawTextWithOutline(text_multiline, x, y)
-            lastY = y
-            
+
+            session.caption_layouts[pos] = (layout_key, (text_multiline, x, y))
+            return text_multiline, x, y
+
+        def drawText(text, pos):
+
+            def drawTextWithOutline(text, x, y):
+
+                # Captions that need fallback fonts are always drawn
+                # from masks, as stroking only supports a single font.
+                if (session.text_renderer == 'mask'
+                        or textrender.needs_fallback(text, session.font_type)):
+                    textrender.draw_outlined_text(
+                        img, (x, y), text, session.font_type, render_text_size,
+                        session.text_color, session.text_outline_color,
+                        render_outline_size, session.align_type
+                    )
+                    return
+                draw.multiline_text(
+                    (x, y), text, session.text_color, font=render_font, 
+                    align=session.align_type, stroke_width=render_outline_size, 
+                    stroke_fill=session.text_outline_color
+                )
+                return
+
+            text_multiline, x, y = layoutText(text, pos)
+            # The layout is in full resolution coordinates
+            drawTextWithOutline(text_multiline, x * scale, y * scale)
             return
 
         # A shallow copy of the image binary is first converted to a
         # PIL image object 
-        img_bytes = copy.copy(self.original_image_bytes)
+        img_bytes = copy.copy(session.selected_image)
         img_bytes.read()
         img = Image.open(img_bytes)
+
+        # Previews are decoded and edited at a bounded size. draft lets
+        # the JPEG decoder do most of the downscaling for free.
+        full_width, full_height = img.size
+        if preview:
+            img.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+            img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+        scale = img.width / full_width
+        img = effects.apply_effects(img, session.effects)
         
         # The caption and whitespace are added here. The font and
         # whitespace properties are decided according to class
         # class attributes.
-        if self.whitespace != WhiteSpace.NONE: img = add_whitespace_func()
+        if session.whitespace != WhiteSpace.NONE: img = add_whitespace_func()
+        layout_width = full_width
+        layout_height = full_height
+        whitespace_height = int(full_height * session.whitespace_ratio)
+        if session.whitespace == WhiteSpace.TOPBOT:
+            layout_height += 2 * whitespace_height
+        elif session.whitespace != WhiteSpace.NONE:
+            layout_height += whitespace_height
+        render_text_size = max(1, round(session.text_size * scale))
+        render_outline_size = round(session.text_ouline_size * scale)
+        if session.text_ouline_size > 0:
+            render_outline_size = max(1, render_outline_size)
         draw = ImageDraw.Draw(img)
-        font = ImageFont.truetype(self.font_type, self.text_size)
-        drawText(self.top_text, "t")
-        drawText(self.bottom_text, "b")
+        font = textrender.load_font(session.font_type, session.text_size)
+        render_font = textrender.load_font(session.font_type, render_text_size)
+        drawText(session.top_text, "t")
+        drawText(session.bottom_text, "b")
 
-        # The PIL image object is converted back to an image binary
+        # The PIL image object is converted back to an image binary.
+        # Previews use cheap encode settings, exports the best quality.
         bytes_object = io.BytesIO()
-        img.save(bytes_object, format='jpeg')
-        self.new_image_binary = bytes_object
+        if preview:
+            img.save(bytes_object, format='jpeg', quality=PREVIEW_QUALITY)
+        else:
+            img.save(bytes_object, format='jpeg', quality=95, subsampling=0,
+                     optimize=True)
+        session.new_image_binary = bytes_object
     
 def setup(bot):
     bot.add_cog(Editor(bot))
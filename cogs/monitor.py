@@ -0,0 +1,50 @@
+"""Monitor cog module.
+
+The monitor cog runs the event loop lag monitor for the whole bot and
+provides an admin command to inspect it. Stalls are also written to the
+log file as soon as they are detected.
+"""
+
+# Discord and discord extension library imports
+from discord.ext import commands
+# Local module imports
+import loopmonitor
+
+# Discord messages are limited to 2000 characters.
+MAX_MESSAGE_LENGTH = 1900
+
+
+class Monitor(commands.Cog):
+    """Class that defines the event loop monitor cog."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.monitor = loopmonitor.LoopMonitor()
+        self.monitor.start(bot.loop)
+
+    def cog_unload(self):
+        self.monitor.stop()
+
+    @commands.group(name='lag', invoke_without_command=True,
+        help="Admin command that shows the event loop lag histogram and"
+        " the most recent stalls.")
+    @commands.is_owner()
+    async def show_lag(self, ctx):
+        await ctx.send('```' + self.monitor.summary()[:MAX_MESSAGE_LENGTH]
+                       + '```')
+
+    @show_lag.command(name='stack',
+        help="Admin command that shows the stack captured for the most"
+        " recent stall.")
+    @commands.is_owner()
+    async def show_lag_stack(self, ctx):
+        if not self.monitor.stalls:
+            await ctx.send("No stalls have been recorded.")
+            return
+        # The innermost frames are at the end of the stack.
+        stack = self.monitor.stalls[-1]['stack'][-MAX_MESSAGE_LENGTH:]
+        await ctx.send('```' + stack + '```')
+
+
+def setup(bot):
+    bot.add_cog(Monitor(bot))
@@ -7,20 +7,34 @@ defined parameters.
 
 # Standard Library imports
 import aiohttp
+import asyncio
+from collections import OrderedDict
+from configparser import ConfigParser
 from io import BytesIO
 import os
+import time
 from dotenv import load_dotenv
 # Discord and discord extension library imports
 import discord
 from discord.ext import commands
+# Local module imports
+import ingest
+import quota
+from singleflight import SingleFlight
+
+# Search results are reused for this many seconds, and for longer when
+# the search quota is running low.
+SEARCH_CACHE_TTL = 10 * 60
+SEARCH_CACHE_SIZE = 20
 
 
 class Query(commands.Cog):
     """Class that defines an image request cog.
 
     Creates an image search request and async sends it to the Bing Image
-    Search V7.0 API in response to user request. Must be loaded before
-    the Editor cog in order to provide it with the selected image.
+    Search V7.0 API in response to user request. The search results and
+    the selected image are kept in the session of the user, which the
+    Editor cog reads the selected image from.
     """
 
     def __init__(
@@ -34,7 +48,6 @@ class Query(commands.Cog):
         self.api_key = os.getenv('BS_API_KEY')
         self.endpoint = os.getenv('END_POINT') + "v7.0/images/search"
         
-        self.query = None
         self.market = mkt
         self.result_count = result_count
         self.offset = 0
@@ -42,16 +55,15 @@ class Query(commands.Cog):
         self.minDim = minDim
         self.maxDim = maxDim
 
-        self.params = {
-            'q': self.query, 'mkt': self.market, 'count': self.result_count, 
-            'offset': self.offset,'safeSearch': moderation,
-            'minWidth': minDim[0], 'minHeight': minDim[1], 
-            'maxWidth': maxDim[0], 'maxHeight': maxDim[1]
-        }
-        
-        self.url_list = None
-        self.img_list = None
-        self.selected_image = None
+        config = ConfigParser()
+        config.read('config.ini')
+        quota_config = config['Search Quota'] if config.has_section('Search Quota') else {}
+        self.quota = quota.QuotaAccountant(
+            per_minute=int(quota_config.get('per_minute', 20)),
+            per_month=int(quota_config.get('per_month', 1000)),
+            soft_limit=float(quota_config.get('soft_limit', 0.9)))
+        self.single_flight = SingleFlight()
+        self.search_cache = OrderedDict()
 
     async def cog_check(self, ctx):
         """Cog level context checker.
@@ -62,43 +74,138 @@ class Query(commands.Cog):
         if isinstance(ctx.channel, discord.DMChannel): return True
         else: return False
 
+    async def cog_before_invoke(self, ctx):
+        """Attaches the session of the user to the context."""
+        ctx.session = await self.bot.get_cog('Sessions').get(ctx.author.id)
+
     @commands.group(name='find', 
         help="Finds and returns images based on a descriptive query.",
         invoke_without_command=True)
     async def find(self, ctx, *, arg: str):
         """ Finds images based on the query param """
 
-        headers = {'Ocp-Apim-Subscription-Key': self.api_key}
-        self.query = arg
-        self.update_params()
-        if self.query is not None:
-            await ctx.send("Finding image results for " + arg + ". Please wait...")
-            # Calls the API
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.endpoint, headers=headers, params=self.params) as response:
-                    #image_urls = []
-                    if response.status == 200:
-                        search_results = await response.json()
-                        self.url_list = [img["contentUrl"] for img in search_results["value"][:self.result_count]]
+        params = self.get_params(arg)
+        if params is not None:
+            ctx.session.query = arg
+            # Queries that only differ in case and spacing share results
+            key = tuple(sorted(
+                dict(params, q=' '.join(arg.lower().split())).items()))
+            level = self.quota.level()
+            cached = self.search_cache.get(key)
+            if cached is not None and (level != quota.QuotaLevel.NORMAL
+                    or time.monotonic() - cached[0] < SEARCH_CACHE_TTL):
+                # Near the quota limits stale results are better than none
+                self.quota.counters['cache_hits'] += 1
+                url_list, images = cached[1]
+            else:
+                # Only a search that starts a new API call uses up quota.
+                # The check, the count and starting the call happen with
+                # no await in between, so concurrent searches can not
+                # overshoot the budgets.
+                if not self.single_flight.in_flight(key):
+                    level = self.quota.try_acquire()
+                    if level != quota.QuotaLevel.NORMAL:
+                        self.quota.counters['refused'] += 1
+                        await ctx.send(self.quota_message(level))
+                        return
+                future = self.single_flight.start(
+                    key, lambda: self.search_images(params))
+                await ctx.send("Finding image results for " + arg + ". Please wait...")
+                url_list, images = await asyncio.shield(future)
+                if url_list is not None:
+                    self.cache_results(key, url_list, images)
+            ctx.session.url_list = url_list
+            if url_list is not None:
+                ctx.session.img_list = []
+                for i, data in enumerate(images):
+                    if data is not None:
+                        # Every user gets their own file object
+                        image_bytes = BytesIO(data)
+                        await ctx.send(file=discord.File(image_bytes, str(i + 1) + '.jpg'))
+                        ctx.session.img_list.append(image_bytes)
                     else:
-                        self.url_list = None
-                await session.close()
-            if self.url_list is not None:
-                self.img_list = []
-                async with aiohttp.ClientSession() as session:
-                    for i in range(self.result_count):
-                        async with session.get(self.url_list[i]) as image_data:
-                            if image_data.status == 200:
-                                image_bytes = BytesIO(await image_data.read())
-                                if image_bytes is not None:
-                                    await ctx.send(file=discord.File(image_bytes, str(i + 1) + '.jpg'))
-                                print(image_bytes)
-                                self.img_list.append(image_bytes)
-                            else:
-                                self.img_list.append(None)
-                                await ctx.send("An unexpected error occured while retrieving this image.")
-                    await session.close()
+                        ctx.session.img_list.append(None)
+                        await ctx.send("An unexpected error occured while retrieving this image.")
+
+    async def search_images(self, params):
+        """Calls the API and downloads the resulting images.
+
+        Returns the url list and a list with the bytes of every image
+        (None for images that could not be retrieved). The url list is
+        None if the API call failed. Concurrent identical searches share
+        a single call through the single flight group. The call must be
+        counted with quota.try_acquire before this is started.
+        """
+        headers = {'Ocp-Apim-Subscription-Key': self.api_key}
+        url_list = None
+        images = []
+        # Calls the API
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.endpoint, headers=headers, params=params) as response:
+                if response.status == 200:
+                    search_results = await response.json()
+                    url_list = [img["contentUrl"] for img in search_results["value"][:self.result_count]]
+            if url_list is not None:
+                for url in url_list:
+                    async with session.get(url) as image_data:
+                        if image_data.status == 200:
+                            images.append(await image_data.read())
+                        else:
+                            images.append(None)
+        return url_list, images
+
+    def cache_results(self, key, url_list, images):
+        """Adds search results to the cache, dropping the oldest ones."""
+        self.search_cache[key] = (time.monotonic(), (url_list, images))
+        self.search_cache.move_to_end(key)
+        while len(self.search_cache) > SEARCH_CACHE_SIZE:
+            self.search_cache.popitem(last=False)
+
+    def quota_message(self, level):
+        """Returns the message shown when a search can not be served."""
+        if level == quota.QuotaLevel.CACHE_ONLY:
+            return ("The bot is close to its search limit, so only recent"
+                    " searches can be served right now. Please try again"
+                    " later, or use !find template or !upload instead.")
+        if self.quota.month_exhausted():
+            return ("The bot has used up its searches for this month."
+                    " You can still use !find template or !upload.")
+        return ("Too many searches are being made right now. Please try"
+                " again in a minute, or use !find template or !upload.")
+
+    @commands.command(name='quota',
+        help="Admin command that shows the search quota counters.")
+    @commands.is_owner()
+    async def show_quota(self, ctx):
+        stats = self.quota.stats()
+        stats['searches_coalesced'] = self.single_flight.coalesced
+        await ctx.send('\n'.join(
+            name + ': ' + str(value) for name, value in stats.items()))
    
+    @find.command(name='template',
+        help="Finds meme templates from the local template cache. The"
+        " cache is filled in the background from the subreddits in the"
+        " config file, so results are instant.")
+    async def find_template(self, ctx, *, arg: str):
+        """ Finds templates in the template cache based on the query """
+
+        templates_instance = self.bot.get_cog('Templates')
+        if templates_instance is None:
+            await ctx.send("Template search is currently unavailable.")
+            return
+        results = await templates_instance.search(arg, self.result_count)
+        if not results:
+            await ctx.send("No templates were found for " + arg + ".")
+            return
+        ctx.session.query = arg
+        ctx.session.url_list = [entry['url'] for entry, _ in results]
+        ctx.session.img_list = []
+        for i, (entry, image_bytes) in enumerate(results):
+            await ctx.send(entry['title'],
+                file=discord.File(image_bytes, str(i + 1) + '.jpg'))
+            image_bytes.seek(0)
+            ctx.session.img_list.append(image_bytes)
+
     @find.command(name='more', 
         help="Command used to find more images for the same query.")
     async def find_more(self, ctx, *, arg):
@@ -106,18 +213,18 @@ class Query(commands.Cog):
     
     @commands.command(name='select', help="Command used to select one of the images for editing.")
     async def select(self, ctx, choice: int):
-        if self.img_list is not None:
-            if choice > 0 and choice <= self.result_count:
+        if ctx.session.img_list is not None:
+            if choice > 0 and choice <= len(ctx.session.img_list):
                 # +1 and -1 are used in this section of the code to account for the fact that users are
                 # likely to enter numbers from 1 to 5 rather than 0 to 4 (max list range)
-                if self.img_list[choice - 1] is not None: 
-                    self.selected_image = self.img_list[choice - 1]
-                    self.selected_image.seek(0) #The seek method is used in case the file was sent before. This would mess with the seek position of the file object
+                if ctx.session.img_list[choice - 1] is not None: 
+                    ctx.session.selected_image = ctx.session.img_list[choice - 1]
+                    ctx.session.selected_image.seek(0) #The seek method is used in case the file was sent before. This would mess with the seek position of the file object
                     await ctx.send("Image number " + str(choice) + " was successfully selected.")
                 else: 
                     await ctx.send("An unexpected error occured while retrieving this image. Please select another.")
             else:
-                await ctx.send("Please enter a valid choice from between 1 to " + str(self.result_count) + ".")
+                await ctx.send("Please enter a valid choice from between 1 to " + str(len(ctx.session.img_list)) + ".")
         else:
             await ctx.send("You need to use the !find command to search for a list of images before you can use this command.")
     
@@ -125,32 +232,34 @@ class Query(commands.Cog):
         help="Command that can be used to upload an image to be edited."
         " Please upload only a single image for editing."
         " If multiple images are uploaded, only the first image will be selected" 
-        " for editing. Only .jpg, .jpeg and .png files are currently supported.")
+        " for editing. Only jpeg and png images of up to 8 MB are currently"
+        " supported.")
     async def upload(self, ctx):
         attachment = None
-        accepted_extension_list = ['.jpg', '.jpeg', '.png']
         if len(ctx.message.attachments) > 0:
             attachment = ctx.message.attachments[0]
-            print("done")
         else:
             await ctx.send("You need to upload an attachment when using this command")
             return
-        for extension in accepted_extension_list:
-            if attachment.filename.endswith(extension):
-                image_bytes = BytesIO()
-                await attachment.save(image_bytes)
-                self.selected_image = image_bytes
-                print(self.selected_image)
-                await ctx.send("Image upload successful.")
-                return
-        await ctx.send("This filename extension is not supported.")
+        # Discord reports the attachment size, so oversized files are
+        # rejected before anything is downloaded.
+        if attachment.size > ingest.MAX_BYTES:
+            await ctx.send("The image is too big. The maximum file size is "
+            + str(ingest.MAX_BYTES // (1024 * 1024)) + " MB.")
+            return
+        try:
+            ctx.session.selected_image = await ingest.fetch_image(attachment.url)
+        except ingest.IngestError as error:
+            await ctx.send(str(error))
+            return
+        await ctx.send("Image upload successful.")
     
     @commands.command(name='show', help="Command used to show the currently selected image.")
     async def show(self, ctx):
-        if self.selected_image is not None:
-            print(self.selected_image)
-            await ctx.send(file=discord.File(self.selected_image, 'selected_image.jpg'))
-            self.selected_image.seek(0)
+        if ctx.session.selected_image is not None:
+            print(ctx.session.selected_image)
+            await ctx.send(file=discord.File(ctx.session.selected_image, 'selected_image.jpg'))
+            ctx.session.selected_image.seek(0)
         else:
             await ctx.send("You need to select an image before using this command.")
 
@@ -159,32 +268,27 @@ class Query(commands.Cog):
         " selected before using this command. You will be unable to use the" 
         " query and find commands once you use this command.")
     async def edit(self,ctx):
-        if self.selected_image is not None:
+        if ctx.session.selected_image is not None:
             #self.bot.unload_extension(f'cogs.query')
-            self.bot.load_extension(f'cogs.editor')
+            try:
+                self.bot.load_extension(f'cogs.editor')
+            except commands.ExtensionAlreadyLoaded:
+                pass
             await ctx.send("The editor has been loaded. You can use commands like !caption top or !whitespace top to edit your image.")
         else:
             await ctx.send("You need to select an image before you can edit it.")
     
-    def update_params(self):
-        """Updates the parameter string. 
+    def get_params(self, query):
+        """Returns the parameter dict for a query. 
         
-        Checks the entered parameters for errors and updates the params
-        attribute if none are found.
+        Checks the entered parameters for errors and returns None if
+        any are found.
         """
-        if len(self.query.strip()) > 100: return # We enforce a hard limit of 100 characters on search queries.
-        if self.result_count > 5: return   # We enforce a 5 image limit on results 
+        if len(query.strip()) > 100: return None # We enforce a hard limit of 100 characters on search queries.
+        if self.result_count > 5: return None   # We enforce a 5 image limit on results 
                                     # to prevent one user from taking up too much bandwith
-        self.params = {'q': self.query, 'mkt': self.market, 'count' : self.result_count, 'offset': self.offset,'safeSearch' : self.moderation,
+        return {'q': query, 'mkt': self.market, 'count' : self.result_count, 'offset': self.offset,'safeSearch' : self.moderation,
         'minWidth' : self.minDim[0], 'minHeight' : self.minDim[1], 'maxWidth' : self.maxDim[0], 'maxHeight' : self.maxDim[1]}
-    
-    def get_selected_image(self):
-        """Returns selected image attribute.
-
-        Used by the Editor cog to retrieve the selected image from the
-        Query cog. 
-        """
-        return self.selected_image
 
 
 def setup(bot):
@@ -0,0 +1,51 @@
+"""Sessions cog module.
+
+The sessions cog owns the per-user editing sessions used by the Query
+and Editor cogs. Because it is loaded separately from them, reloading
+the editor does not throw away any work. Idle sessions are hibernated
+to a SQLite database in the background and restored on demand.
+"""
+
+# Standard library imports
+import logging
+# Discord and discord extension library imports
+from discord.ext import commands, tasks
+# Local module imports
+import sessions
+
+logger = logging.getLogger('discord')
+
+
+class Sessions(commands.Cog):
+    """Class that defines the session manager cog.
+
+    Other cogs get the session of the user invoking a command by
+    awaiting the get method, usually from their cog_before_invoke hook.
+    """
+
+    def __init__(self, bot, store=None, idle_timeout=sessions.IDLE_TIMEOUT):
+        self.bot = bot
+        self.manager = sessions.SessionManager(
+            store or sessions.SessionStore(), idle_timeout)
+        self.hibernate_idle.start()
+
+    def cog_unload(self):
+        self.hibernate_idle.cancel()
+        self.manager.hibernate_all()
+        self.manager.store.close()
+
+    @tasks.loop(minutes=1)
+    async def hibernate_idle(self):
+        """Background task that moves idle sessions out of memory."""
+        count = await self.manager.hibernate_idle(self.bot.loop)
+        if count:
+            logger.info('Hibernated %d idle sessions (%d active).',
+                        count, len(self.manager.sessions))
+
+    async def get(self, user_id):
+        """Returns the session of the user."""
+        return await self.manager.get(user_id, self.bot.loop)
+
+
+def setup(bot):
+    bot.add_cog(Sessions(bot))
@@ -0,0 +1,100 @@
+"""Templates cog module.
+
+The templates cog keeps the local template cache warm. It reads the
+subreddits from the config file and periodically prefetches their top
+image posts in the background, so the Query cog can serve template
+searches without a network request.
+"""
+
+# Standard library imports
+import asyncio
+import logging
+from configparser import ConfigParser
+# Discord and discord extension library imports
+from discord.ext import commands, tasks
+# Local module imports
+import templatecache
+
+logger = logging.getLogger('discord')
+
+
+class Templates(commands.Cog):
+    """Class that defines the template prefetching cog.
+
+    Owns the template cache and a background task that refreshes it.
+    The fetcher can be replaced with any object that implements the
+    RedditFetcher methods, e.g. a local stand-in.
+    """
+
+    def __init__(self, bot, fetcher=None, cache=None, refresh_minutes=60):
+        self.bot = bot
+        config = ConfigParser()
+        config.read('config.ini')
+        self.subreddits = templatecache.read_subreddits(config)
+        self.fetcher = fetcher or templatecache.RedditFetcher()
+        self.cache = cache or templatecache.TemplateCache()
+
+        self.refresh_minutes = refresh_minutes
+        self.restart_handle = None
+        self.prefetch.change_interval(minutes=refresh_minutes)
+        if self.subreddits:
+            self.prefetch.start()
+
+    def cog_unload(self):
+        if self.restart_handle is not None:
+            self.restart_handle.cancel()
+        self.prefetch.cancel()
+
+    @tasks.loop(minutes=60)
+    async def prefetch(self):
+        """Background task that refreshes the template cache."""
+        added = await templatecache.refresh(
+            self.cache, self.fetcher, self.subreddits,
+            asyncio.get_event_loop())
+        logger.info('Template prefetch added %d templates (%d cached).',
+                    added, len(self.cache.index))
+
+    @prefetch.error
+    async def prefetch_error(self, error):
+        """Logs a failed refresh and restarts the task.
+
+        tasks.loop stops for good after an unhandled error, so the task
+        is started again after the refresh interval.
+        """
+        logger.error('Template prefetch failed, retrying in %d minutes.',
+                     self.refresh_minutes, exc_info=error)
+        self.restart_handle = self.bot.loop.call_later(
+            self.refresh_minutes * 60, self.restart_prefetch)
+
+    def restart_prefetch(self):
+        self.restart_handle = None
+        if not self.prefetch.is_running():
+            failed_task = self.prefetch.get_task()
+            if failed_task is not None and not failed_task.cancelled():
+                failed_task.exception()  # Already logged by prefetch_error
+            self.prefetch.start()
+
+    @prefetch.before_loop
+    async def before_prefetch(self):
+        await self.bot.wait_until_ready()
+
+    async def search(self, query, limit=5):
+        """Returns up to limit (entry, BytesIO) pairs from the cache.
+
+        The index is searched on the event loop, only the image files
+        are read in the default executor.
+        """
+        loop = asyncio.get_event_loop()
+        results = []
+        for digest, entry in self.cache.search(query, limit):
+            try:
+                image_bytes = await loop.run_in_executor(
+                    None, self.cache.load, digest)
+            except FileNotFoundError:
+                continue
+            results.append((entry, image_bytes))
+        return results
+
+
+def setup(bot):
+    bot.add_cog(Templates(bot))
@@ -0,0 +1,232 @@
+"""Font coverage module.
+
+Contains a glyph coverage index of the bundled fonts, used to pick a
+fallback font for characters the caption font does not have (e.g.
+Hangul in Impact). The codepoints every font maps to a glyph are read
+from its cmap table once, stored as sorted ranges and cached on disk,
+so looking up which font covers a character is a binary search instead
+of a trial render.
+"""
+
+# Standard library imports
+import bisect
+import json
+import os
+import struct
+from functools import lru_cache
+
+FONT_DIR = 'fonts'
+CACHE_PATH = 'font_coverage.json'
+# Fonts tried in this order when the caption font lacks a character.
+FALLBACK_FONTS = [
+    'GothicA1-Regular.ttf',
+    'Montserrat-Regular.ttf',
+    'arial.ttf',
+    'COMIC.TTF',
+]
+
+
+def read_cmap_ranges(path):
+    """Returns the sorted (start, end) codepoint ranges a font covers.
+
+    Reads the best unicode subtable of the cmap table: format 12 (full
+    unicode) if the font has one, otherwise format 4 (BMP only).
+    Codepoints mapped to the missing glyph are left out.
+    """
+    with open(path, 'rb') as font_file:
+        data = font_file.read()
+    num_tables = struct.unpack_from('>H', data, 4)[0]
+    cmap_offset = None
+    for i in range(num_tables):
+        tag, _, offset, _ = struct.unpack_from('>4sIII', data, 12 + 16 * i)
+        if tag == b'cmap':
+            cmap_offset = offset
+    if cmap_offset is None:
+        return []
+
+    subtables = {}
+    num_subtables = struct.unpack_from('>H', data, cmap_offset + 2)[0]
+    for i in range(num_subtables):
+        platform, encoding, offset = struct.unpack_from(
+            '>HHI', data, cmap_offset + 4 + 8 * i)
+        subtable = cmap_offset + offset
+        subtable_format = struct.unpack_from('>H', data, subtable)[0]
+        if platform == 0 or (platform == 3 and encoding in (1, 10)):
+            subtables.setdefault(subtable_format, subtable)
+
+    if 12 in subtables:
+        return merge_ranges(read_format_12(data, subtables[12]))
+    if 4 in subtables:
+        return merge_ranges(read_format_4(data, subtables[4]))
+    return []
+
+
+def read_format_12(data, offset):
+    num_groups = struct.unpack_from('>I', data, offset + 12)[0]
+    ranges = []
+    for i in range(num_groups):
+        start, end, glyph = struct.unpack_from(
+            '>III', data, offset + 16 + 12 * i)
+        if glyph == 0:
+            start += 1
+        if start <= end:
+            ranges.append((start, end))
+    return ranges
+
+
+def read_format_4(data, offset):
+    seg_count = struct.unpack_from('>H', data, offset + 6)[0] // 2
+    ends_offset = offset + 14
+    starts_offset = ends_offset + 2 * seg_count + 2
+    deltas_offset = starts_offset + 2 * seg_count
+    range_offsets_offset = deltas_offset + 2 * seg_count
+    ends = struct.unpack_from(f'>{seg_count}H', data, ends_offset)
+    starts = struct.unpack_from(f'>{seg_count}H', data, starts_offset)
+    deltas = struct.unpack_from(f'>{seg_count}h', data, deltas_offset)
+    range_offsets = struct.unpack_from(
+        f'>{seg_count}H', data, range_offsets_offset)
+
+    ranges = []
+    for i in range(seg_count):
+        start, end = starts[i], ends[i]
+        if start == 0xFFFF:
+            continue
+        if range_offsets[i] == 0:
+            # Every character in the segment maps to code + delta
+            for code in range(start, end + 1):
+                if (code + deltas[i]) & 0xFFFF:
+                    ranges.append((code, code))
+            continue
+        for code in range(start, end + 1):
+            glyph_offset = (range_offsets_offset + 2 * i + range_offsets[i]
+                            + 2 * (code - start))
+            if glyph_offset + 2 > len(data):
+                break
+            glyph = struct.unpack_from('>H', data, glyph_offset)[0]
+            if glyph and (glyph + deltas[i]) & 0xFFFF:
+                ranges.append((code, code))
+    return ranges
+
+
+def merge_ranges(ranges):
+    """Merges overlapping and adjacent ranges."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class CoverageIndex:
+    """Class that maps every bundled font to the codepoints it covers.
+
+    The ranges of every font are cached in a JSON file and only read
+    from the font again when its size or modification time changes.
+    """
+
+    def __init__(self, font_dir=FONT_DIR, cache_path=CACHE_PATH):
+        self.font_dir = font_dir
+        self.cache_path = cache_path
+        self.starts = {}
+        self.ends = {}
+        self.char_fonts = {}
+        self.build()
+        self.fallbacks = [
+            os.path.join(font_dir, name) for name in FALLBACK_FONTS
+            if os.path.join(font_dir, name) in self.starts
+        ]
+
+    def build(self):
+        """Reads the coverage of every font, using the cache if valid."""
+        cache = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, encoding='utf-8') as cache_file:
+                cache = json.load(cache_file)
+        changed = False
+        for name in sorted(os.listdir(self.font_dir)):
+            if not name.lower().endswith(('.ttf', '.otf')):
+                continue
+            path = os.path.join(self.font_dir, name)
+            stat = os.stat(path)
+            entry = cache.get(path)
+            if (entry is None or entry['size'] != stat.st_size
+                    or entry['mtime'] != stat.st_mtime):
+                try:
+                    ranges = read_cmap_ranges(path)
+                except struct.error:
+                    continue
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                         'ranges': ranges}
+                cache[path] = entry
+                changed = True
+            self.starts[path] = [start for start, _ in entry['ranges']]
+            self.ends[path] = [end for _, end in entry['ranges']]
+        if changed:
+            with open(self.cache_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(cache, cache_file)
+
+    def resolve(self, font_type):
+        """Returns the indexed path of a font name or path, or None."""
+        if font_type in self.starts:
+            return font_type
+        name = os.path.basename(font_type).lower()
+        if not name.endswith(('.ttf', '.otf')):
+            name += '.ttf'
+        for path in self.starts:
+            if os.path.basename(path).lower() == name:
+                return path
+        return None
+
+    def covers(self, path, code):
+        """Returns whether the font at path has a glyph for code."""
+        i = bisect.bisect_right(self.starts[path], code) - 1
+        return i >= 0 and code <= self.ends[path][i]
+
+    def font_for(self, char, font_type):
+        """Returns the font to draw char with.
+
+        That is font_type itself if it covers the character, otherwise
+        the first fallback font that does. Fonts that are not indexed
+        and characters no font covers keep font_type.
+        """
+        key = (char, font_type)
+        font = self.char_fonts.get(key)
+        if font is None:
+            font = font_type
+            primary = self.resolve(font_type)
+            if (primary is not None and not char.isspace()
+                    and not self.covers(primary, ord(char))):
+                for fallback in self.fallbacks:
+                    if self.covers(fallback, ord(char)):
+                        font = fallback
+                        break
+            self.char_fonts[key] = font
+        return font
+
+    def needs_fallback(self, text, font_type):
+        """Returns whether any character needs a fallback font."""
+        return any(self.font_for(char, font_type) != font_type
+                   for char in set(text))
+
+    def split_runs(self, text, font_type):
+        """Splits a line of text into (run, font) pairs.
+
+        Whitespace stays in the current run so runs are only split
+        where the font actually changes.
+        """
+        runs = []
+        for char in text:
+            font = self.font_for(char, font_type)
+            if runs and (font == runs[-1][1] or char.isspace()):
+                runs[-1][0].append(char)
+            else:
+                runs.append(([char], font))
+        return [(''.join(chars), font) for chars, font in runs]
+
+
+@lru_cache(maxsize=None)
+def get_index():
+    """Returns the shared coverage index, building it on first use."""
+    return CoverageIndex()
@@ -0,0 +1,114 @@
+"""Image ingest module.
+
+Contains the code used to safely download user supplied images. The
+image is streamed with a hard byte cap, its format is sniffed from the
+magic bytes rather than the filename, and its dimensions are read from
+the header and checked against a pixel budget before anything is
+decoded. Oversized or malformed images are rejected as early as
+possible so they never reach the editor.
+"""
+
+# Standard library imports
+from io import BytesIO
+import aiohttp
+# PIL (Pillow) image editing library import
+from PIL import Image
+
+# Default limits. Discord does not allow regular uploads over 8 MiB and
+# a 4096x4096 image is plenty for a meme.
+MAX_BYTES = 8 * 1024 * 1024
+MAX_PIXELS = 4096 * 4096
+CHUNK_SIZE = 64 * 1024
+# The dimensions have to be found within this many bytes. Large enough
+# for jpeg files with big EXIF and ICC segments in front of the frame.
+HEADER_LIMIT = 512 * 1024
+
+# Magic bytes of the supported image formats.
+MAGIC_NUMBERS = {
+    b'\xff\xd8\xff': 'JPEG',
+    b'\x89PNG\r\n\x1a\n': 'PNG',
+}
+
+
+class IngestError(Exception):
+    """A custom exception used to report why an image was rejected.
+
+    The message is meant to be shown to the user.
+    """
+
+
+def sniff_format(header):
+    """Returns the image format based on the magic bytes or None."""
+    for magic, image_format in MAGIC_NUMBERS.items():
+        if header.startswith(magic):
+            return image_format
+    return None
+
+
+def read_dimensions(data):
+    """Returns the (width, height) from the image header or None.
+
+    Image.open only parses the header, so this does not decode any
+    pixel data. None is returned while the header is still incomplete.
+    """
+    try:
+        with Image.open(BytesIO(data)) as img:
+            return img.size
+    except Image.DecompressionBombError as error:
+        raise IngestError("The image is too large.") from error
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+
+def check_dimensions(size, max_pixels):
+    """Raises an IngestError if the image is over the pixel budget."""
+    width, height = size
+    if width * height > max_pixels:
+        raise IngestError(
+            f"The image is too large ({width}x{height}). The maximum "
+            f"supported size is {max_pixels} pixels.")
+
+
+async def fetch_image(url, max_bytes=MAX_BYTES, max_pixels=MAX_PIXELS):
+    """Streams the image at url into a BytesIO object.
+
+    Stops and raises an IngestError as soon as the download goes over
+    max_bytes, the magic bytes do not belong to a supported format or
+    the header reports more than max_pixels pixels.
+    """
+    data = bytearray()
+    size = None
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise IngestError(
+                    "An unexpected error occured while retrieving the image.")
+            if (response.content_length is not None
+                    and response.content_length > max_bytes):
+                raise IngestError(
+                    f"The image is too big. The maximum file size is "
+                    f"{max_bytes // (1024 * 1024)} MB.")
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                data.extend(chunk)
+                if len(data) > max_bytes:
+                    raise IngestError(
+                        f"The image is too big. The maximum file size is "
+                        f"{max_bytes // (1024 * 1024)} MB.")
+                if len(data) >= 8 and sniff_format(bytes(data[:8])) is None:
+                    raise IngestError(
+                        "This file type is not supported. Only jpeg and png "
+                        "images can be used.")
+                if size is None:
+                    size = read_dimensions(bytes(data))
+                    if size is not None:
+                        check_dimensions(size, max_pixels)
+                    elif len(data) >= HEADER_LIMIT:
+                        raise IngestError("The image could not be read.")
+
+    if sniff_format(bytes(data[:8])) is None:
+        raise IngestError(
+            "This file type is not supported. Only jpeg and png images can "
+            "be used.")
+    if size is None:
+        raise IngestError("The image could not be read.")
+    return BytesIO(bytes(data))
@@ -0,0 +1,224 @@
+"""Load test harness.
+
+Drives simulated users through the real find -> select -> edit ->
+caption/whitespace/text command flow of one bot process and reports
+throughput, command latency and memory use for increasing numbers of
+concurrent users. Discord is replaced by fake contexts that record
+what the bot sends, and the Bing endpoint and the image hosts are
+replaced by a local HTTP server, so no tokens or network are needed.
+
+Usage: python loadtest.py --users 1 5 10 25 --images 5
+"""
+
+# Standard library imports
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from aiohttp import web
+# Discord and discord extension library imports
+import discord
+from discord.ext import commands
+from discord.ext.commands.view import StringView
+# PIL (Pillow) image editing library import
+from PIL import Image
+
+SEARCH_PHRASES = ['distracted boyfriend', 'drake hotline', 'surprised pikachu',
+                  'this is fine', 'change my mind', 'galaxy brain']
+CAPTIONS = ['when the code finally compiles',
+            'me explaining the bug to the rubber duck',
+            'nobody:', 'works on my machine']
+
+
+class FakeAuthor:
+    """Stand-in for the discord user that sends a command."""
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.bot = False
+        self.name = f'user{user_id}'
+
+
+class FakeMessage:
+    """Stand-in for a discord message in a DM channel."""
+
+    def __init__(self, content, author, channel):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.attachments = []
+        self.guild = None
+        self._state = None
+
+
+class FakeContext(commands.Context):
+    """Context that records send calls instead of calling discord."""
+
+    async def send(self, content=None, **kwargs):
+        file = kwargs.get('file')
+        size = 0
+        if file is not None:
+            size = len(file.fp.read())
+            file.close()
+        self.sent.append((content, size))
+
+
+def make_image(seed, size=(1024, 768)):
+    """Returns a jpeg test image with some detail in it."""
+    rng = random.Random(seed)
+    img = Image.effect_mandelbrot(
+        size, (-2 + rng.random(), -1.2, 0.6, 1.2), 60).convert('RGB')
+    bytes_object = io.BytesIO()
+    img.save(bytes_object, format='jpeg', quality=90)
+    return bytes_object.getvalue()
+
+
+async def start_server(image_count):
+    """Starts the local Bing and image host stand-in.
+
+    Returns the runner and the base url of the server.
+    """
+    images = [make_image(i) for i in range(image_count)]
+    base_url = None
+
+    async def search(request):
+        await asyncio.sleep(0.05)  # Simulates the API round trip
+        count = int(request.query.get('count', 5))
+        return web.json_response({'value': [
+            {'contentUrl': f'{base_url}images/{i % image_count}.jpg'}
+            for i in range(count)]})
+
+    async def image(request):
+        return web.Response(body=images[int(request.match_info['number'])],
+                            content_type='image/jpeg')
+
+    app = web.Application()
+    app.router.add_get('/v7.0/images/search', search)
+    app.router.add_get('/images/{number}.jpg', image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base_url = f'http://127.0.0.1:{port}/'
+    return runner, base_url
+
+
+def make_bot(database_path):
+    """Returns a bot with the real Sessions and Query cogs loaded."""
+    from cogs.query import Query
+    from cogs.sessions import Sessions
+    import quota
+    import sessions
+
+    bot = commands.Bot(command_prefix='!')
+    bot.add_cog(Sessions(bot, sessions.SessionStore(database_path)))
+    query = Query(bot)
+    # The load test should not use up or write the real search quota.
+    query.quota = quota.QuotaAccountant(
+        per_minute=10 ** 6, per_month=10 ** 9,
+        path=os.path.join(os.path.dirname(database_path), 'quota.json'))
+    bot.add_cog(query)
+    return bot
+
+
+async def run_command(bot, user, channel, content, latencies):
+    """Parses and invokes a command the way the bot would.
+
+    Returns the context, which holds what was sent and whether the
+    command failed.
+    """
+    message = FakeMessage(content, user, channel)
+    view = StringView(content)
+    ctx = FakeContext(prefix='!', view=view, bot=bot, message=message)
+    ctx.sent = []
+    view.skip_string('!')
+    ctx.invoked_with = view.get_word()
+    ctx.command = bot.all_commands.get(ctx.invoked_with)
+    start = time.perf_counter()
+    await bot.invoke(ctx)
+    latencies.append(time.perf_counter() - start)
+    return ctx
+
+
+async def simulate_user(bot, user_id, latencies, upload_bytes, failures):
+    """Runs one user through the full editing flow."""
+    rng = random.Random(user_id)
+    user = FakeAuthor(user_id)
+    channel = discord.DMChannel.__new__(discord.DMChannel)
+    flow = [
+        '!find ' + rng.choice(SEARCH_PHRASES),
+        f'!select {rng.randint(1, 5)}',
+        '!edit',
+        '!caption top ' + rng.choice(CAPTIONS),
+        '!caption bot ' + rng.choice(CAPTIONS),
+        '!whitespace top',
+        f'!text size {rng.randint(30, 60)}',
+        '!text align ' + rng.choice(['left', 'center', 'right']),
+    ]
+    for content in flow:
+        ctx = await run_command(bot, user, channel, content, latencies)
+        upload_bytes.append(sum(size for _, size in ctx.sent))
+        if ctx.command_failed:
+            failures.append(content)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+async def main(user_counts, image_count):
+    runner, base_url = await start_server(image_count)
+    os.environ['END_POINT'] = base_url
+    os.environ['BS_API_KEY'] = 'loadtest'
+    # Lets Pillow find the bundled fonts (fonts/impact.ttf) by name.
+    os.environ['XDG_DATA_DIRS'] = os.path.dirname(os.path.abspath(__file__))
+    database_path = os.path.join(tempfile.mkdtemp(), 'sessions.db')
+    bot = make_bot(database_path)
+
+    print(f"{'users':>6} {'commands':>9} {'wall s':>8} {'cmd/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'KiB/cmd':>8} {'max RSS MiB':>12} "
+          f"{'failed':>7}")
+    next_user_id = 1
+    for user_count in user_counts:
+        latencies = []
+        upload_bytes = []
+        failures = []
+        user_ids = range(next_user_id, next_user_id + user_count)
+        next_user_id += user_count
+        start = time.perf_counter()
+        # The cogs print debugging output, which is not part of the test.
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.gather(*[
+                simulate_user(
+                    bot, user_id, latencies, upload_bytes, failures)
+                for user_id in user_ids])
+        wall = time.perf_counter() - start
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{user_count:>6} {len(latencies):>9} {wall:>8.2f} '
+              f'{len(latencies) / wall:>8.1f} '
+              f'{percentile(latencies, 0.5) * 1000:>8.1f} '
+              f'{percentile(latencies, 0.99) * 1000:>8.1f} '
+              f'{sum(upload_bytes) / len(upload_bytes) / 1024:>8.1f} '
+              f'{max_rss:>12.1f} {len(failures):>7}')
+
+    bot.remove_cog('Sessions')
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 5, 10, 25],
+                        help='numbers of concurrent users to simulate')
+    parser.add_argument('--images', type=int, default=5,
+                        help='number of distinct images served')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    asyncio.run(main(args.users, args.images))
@@ -0,0 +1,145 @@
+"""Event loop monitor module.
+
+Contains a monitor that continuously measures event loop lag and a
+watchdog that catches blocking calls. A small coroutine wakes up at a
+fixed interval and records how late it woke up in a histogram. A
+watchdog thread checks that the coroutine keeps waking up; when the
+loop has been stuck for longer than a threshold it captures the stack
+of the event loop thread, which shows the exact blocking call, and the
+task that was running at the time.
+"""
+
+# Standard library imports
+import asyncio
+import bisect
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger('discord')
+
+# Upper bounds (in ms) of the lag histogram buckets. The last bucket
+# holds everything above the last bound.
+BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000]
+
+
+class LoopMonitor:
+    """Class that measures event loop lag and records stalls.
+
+    interval is how often the loop is sampled and threshold is how long
+    the loop has to be blocked (in seconds) for a stall to be captured.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.25, max_stalls=20):
+        self.interval = interval
+        self.threshold = threshold
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+        self.samples = 0
+        self.max_lag = 0.0
+        self.stalls = collections.deque(maxlen=max_stalls)
+
+        self.loop = None
+        self.task = None
+        self.thread = None
+        self.loop_thread_id = None
+        self.heartbeat = None
+        self.pending_stall = None
+        self.stopped = threading.Event()
+
+    def start(self, loop):
+        """Starts the sampling task on loop and the watchdog thread."""
+        self.loop = loop
+        self.stopped.clear()
+        self.task = loop.create_task(self.measure())
+        self.thread = threading.Thread(
+            target=self.watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def measure(self):
+        """Coroutine that samples the event loop lag."""
+        self.loop_thread_id = threading.get_ident()
+        while True:
+            start = time.monotonic()
+            self.heartbeat = start
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - start - self.interval, 0.0)
+            self.record(lag)
+            if self.pending_stall is not None:
+                # The watchdog only saw the start of the stall.
+                self.pending_stall['blocked'] = lag
+                self.pending_stall = None
+
+    def record(self, lag):
+        """Adds a lag sample (in seconds) to the histogram."""
+        self.histogram[bisect.bisect_left(BUCKETS_MS, lag * 1000)] += 1
+        self.samples += 1
+        self.max_lag = max(self.max_lag, lag)
+
+    def watch(self):
+        """Watchdog thread that captures the stack of blocked loops."""
+        captured = None
+        while not self.stopped.wait(self.threshold / 4):
+            heartbeat = self.heartbeat
+            if heartbeat is None or heartbeat == captured:
+                continue
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked > self.threshold:
+                captured = heartbeat
+                self.capture_stall(blocked)
+
+    def capture_stall(self, blocked):
+        """Records the stack of the event loop thread and its task."""
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = ''.join(traceback.format_stack(frame)) if frame else ''
+        task = asyncio.current_task(self.loop)
+        task_name = None
+        if task is not None:
+            task_name = task.get_coro().__qualname__
+        stall = {
+            'time': time.time(),
+            'blocked': blocked,
+            'task': task_name,
+            'stack': stack,
+        }
+        self.stalls.append(stall)
+        self.pending_stall = stall
+        logger.warning('Event loop blocked for more than %.0f ms in %s:\n%s',
+                       blocked * 1000, task_name, stack)
+
+    def percentile(self, fraction):
+        """Returns the bucket bound (in ms) of the given lag percentile."""
+        if not self.samples:
+            return 0
+        target = fraction * self.samples
+        count = 0
+        for bound, bucket in zip(BUCKETS_MS + [None], self.histogram):
+            count += bucket
+            if count >= target:
+                return bound if bound is not None else self.max_lag * 1000
+        return self.max_lag * 1000
+
+    def summary(self):
+        """Returns a short text report of the lag and recent stalls."""
+        lines = [
+            f'samples: {self.samples}, p50 <= {self.percentile(0.5)} ms, '
+            f'p99 <= {self.percentile(0.99)} ms, '
+            f'max: {self.max_lag * 1000:.0f} ms, stalls: {len(self.stalls)}'
+        ]
+        bounds = [f'<={bound}ms' for bound in BUCKETS_MS]
+        bounds.append(f'>{BUCKETS_MS[-1]}ms')
+        lines.append(', '.join(
+            f'{bound}: {count}'
+            for bound, count in zip(bounds, self.histogram) if count))
+        for stall in list(self.stalls)[-5:]:
+            lines.append(
+                time.strftime('%H:%M:%S', time.localtime(stall['time']))
+                + f" {stall['blocked'] * 1000:.0f} ms in {stall['task']}")
+        return '\n'.join(lines)
@@ -16,6 +16,8 @@ from dotenv import load_dotenv
 # Discord and discord extensions library imports
 import discord
 from discord.ext import commands
+# Local module imports
+import fontcoverage
 
 # Setup of a logging system. The logger contained in Discord.py is used
 logger = logging.getLogger('discord')
@@ -74,13 +76,27 @@ async def meme(ctx):
 async def refresh(ctx):
     """Debugging command for refreshing the editor cog.
 
-    Reloads the editor cog. Will be removed in final version.
+    Reloads the editor cog. Will be removed in final version. The
+    editing sessions are kept by the sessions cog, so no work is lost.
     """
     bot.unload_extension(f'cogs.editor')
     bot.load_extension(f'cogs.editor')
     await ctx.send("refreshed.")
 
+# The sessions cog holds the editing sessions of all users, the
+# templates cog prefetches meme templates in the background and the
+# monitor cog watches the event loop for blocking calls, so they are
+# loaded as soon as the bot starts.
+bot.load_extension('cogs.monitor')
+bot.load_extension('cogs.sessions')
+bot.load_extension('cogs.templates')
+# Builds the glyph coverage index of the bundled fonts (or loads it
+# from its cache) so captions never wait for it.
+fontcoverage.get_index()
+
 # Loading Bot Discord Token from the .env file.
 load_dotenv()
 discord_token = os.getenv('DISCORD_TOKEN')
-bot.run(discord_token)
\ No newline at end of file
+# bot.run unloads every extension when the bot closes, so the sessions
+# cog hibernates the remaining sessions and a restart does not lose them.
+bot.run(discord_token)
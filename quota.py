@@ -0,0 +1,117 @@
+"""Quota module.
+
+Contains the accountant that tracks how much of the Bing Image Search
+API quota has been used. It keeps a sliding per-minute window and a
+per-month counter that is saved to disk so it survives restarts. As
+usage approaches a budget the accountant degrades the service: first
+only cached results are served, then searches are refused.
+"""
+
+# Standard library imports
+import collections
+import json
+import os
+import time
+from enum import Enum
+
+QUOTA_PATH = 'quota.json'
+
+
+class QuotaLevel(Enum):
+    """Enum describing how searches are served at the current usage."""
+    NORMAL = 1
+    CACHE_ONLY = 2
+    REFUSED = 3
+
+
+class QuotaAccountant:
+    """Class that counts API calls against per-minute and monthly budgets.
+
+    Once either budget is soft_limit (a fraction) used up the level
+    becomes CACHE_ONLY, and once the budget is used up it becomes
+    REFUSED.
+    """
+
+    def __init__(self, per_minute=20, per_month=1000, soft_limit=0.9,
+                 path=QUOTA_PATH):
+        self.per_minute = per_minute
+        self.per_month = per_month
+        self.soft_limit = soft_limit
+        self.path = path
+
+        self.recent_calls = collections.deque()
+        self.month = time.strftime('%Y-%m')
+        self.month_calls = 0
+        self.counters = collections.Counter()
+        self.load()
+
+    def load(self):
+        """Loads the monthly counter saved by an earlier run."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as quota_file:
+            saved = json.load(quota_file)
+        if saved.get('month') == self.month:
+            self.month_calls = saved.get('calls', 0)
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as quota_file:
+            json.dump({'month': self.month, 'calls': self.month_calls},
+                      quota_file)
+
+    def update_window(self):
+        """Drops calls older than a minute and resets at a new month."""
+        now = time.monotonic()
+        while self.recent_calls and now - self.recent_calls[0] > 60:
+            self.recent_calls.popleft()
+        month = time.strftime('%Y-%m')
+        if month != self.month:
+            self.month = month
+            self.month_calls = 0
+
+    def level(self):
+        """Returns the QuotaLevel for the current usage."""
+        self.update_window()
+        usage = max(len(self.recent_calls) / self.per_minute,
+                    self.month_calls / self.per_month)
+        if usage >= 1:
+            return QuotaLevel.REFUSED
+        if usage >= self.soft_limit:
+            return QuotaLevel.CACHE_ONLY
+        return QuotaLevel.NORMAL
+
+    def record_call(self):
+        """Counts one API call against both budgets."""
+        self.update_window()
+        self.recent_calls.append(time.monotonic())
+        self.month_calls += 1
+        self.counters['api_calls'] += 1
+        self.save()
+
+    def try_acquire(self):
+        """Returns the QuotaLevel and counts a call if it is NORMAL.
+
+        Checking and counting happen in one synchronous step, so
+        concurrent searches can not all pass the check before any of
+        them is counted.
+        """
+        level = self.level()
+        if level == QuotaLevel.NORMAL:
+            self.record_call()
+        return level
+
+    def month_exhausted(self):
+        return self.month_calls >= self.per_month
+
+    def stats(self):
+        """Returns the usage and event counters for monitoring."""
+        self.update_window()
+        stats = {
+            'level': self.level().name,
+            'calls_last_minute': len(self.recent_calls),
+            'per_minute_budget': self.per_minute,
+            'calls_this_month': self.month_calls,
+            'per_month_budget': self.per_month,
+        }
+        stats.update(self.counters)
+        return stats
@@ -0,0 +1,239 @@
+"""Sessions module.
+
+Contains the per-user editing session and the code used to hibernate
+idle sessions to a local SQLite database. A hibernated session is
+stored as a compact style record (only the settings that differ from
+the defaults) plus a reference to its image, and image blobs are
+stored once per content hash no matter how many users selected them.
+Sessions are restored lazily the next time their user runs a command.
+"""
+
+# Standard library imports
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from enum import Enum
+from io import BytesIO
+
+DATABASE_PATH = 'sessions.db'
+# Sessions unused for this many seconds are moved out of memory.
+IDLE_TIMEOUT = 15 * 60
+
+
+class WhiteSpace(Enum):
+    """Enum describing the various whitespace states."""
+    TOP = 1
+    BOT = 2
+    TOPBOT = 3
+    NONE = 4
+
+
+class Session:
+    """Class that holds the editing state of a single user.
+
+    Only the selected image and the attributes in STYLE_DEFAULTS are
+    persisted, everything else (search results, rendered previews and
+    cached layouts) is rebuilt on demand.
+    """
+
+    STYLE_DEFAULTS = {
+        'top_text': "",
+        'bottom_text': "",
+        'align_type': 'center',
+        'font_type': 'impact',
+        'text_size': 42,
+        'text_color': 'white',
+        'text_outline_color': 'black',
+        'text_ouline_size': 2,
+        'text_renderer': 'stroke',
+        'whitespace': WhiteSpace.NONE,
+        'whitespace_ratio': 0.25,
+        'effects': (),
+    }
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.last_used = time.monotonic()
+
+        self.selected_image = None
+        self.query = None
+        self.url_list = None
+        self.img_list = None
+
+        self.new_image_binary = None
+        self.caption_layouts = {}
+        for name, value in self.STYLE_DEFAULTS.items():
+            setattr(self, name, value)
+
+    def style_record(self):
+        """Returns the settings that differ from the defaults as JSON."""
+        style = {}
+        for name, default in self.STYLE_DEFAULTS.items():
+            value = getattr(self, name)
+            if value != default:
+                style[name] = value.name if isinstance(value, Enum) else value
+        return json.dumps(style, separators=(',', ':'))
+
+    def snapshot(self):
+        """Returns the (user_id, image data, style record) to store."""
+        data = None
+        if self.selected_image is not None:
+            data = self.selected_image.getvalue()
+        return self.user_id, data, self.style_record()
+
+    def apply_style_record(self, record):
+        """Restores the settings saved by style_record."""
+        for name, value in json.loads(record).items():
+            if name not in self.STYLE_DEFAULTS:
+                continue
+            if isinstance(self.STYLE_DEFAULTS[name], Enum):
+                value = type(self.STYLE_DEFAULTS[name])[value]
+            elif isinstance(self.STYLE_DEFAULTS[name], tuple):
+                value = tuple(tuple(item) for item in value)
+            setattr(self, name, value)
+
+
+class SessionStore:
+    """Class that stores hibernated sessions in a SQLite database.
+
+    Hibernation batches are written from an executor thread while
+    sessions are loaded on the event loop, so the connection is shared
+    between threads and every use of it holds the lock. Batches that
+    were still queued when the store was closed are dropped, the final
+    save on shutdown already includes their sessions.
+    """
+
+    def __init__(self, path=DATABASE_PATH):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.closed = False
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'hash TEXT PRIMARY KEY, data BLOB NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'user_id INTEGER PRIMARY KEY, image_hash TEXT, '
+                'style TEXT NOT NULL, updated REAL NOT NULL)')
+
+    def save_all(self, snapshots):
+        """Writes a batch of Session.snapshot tuples in one transaction.
+
+        Images are stored once per content hash, and images no session
+        refers to any more are removed once for the whole batch.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            with self.connection:
+                for user_id, data, style in snapshots:
+                    image_hash = None
+                    if data is not None:
+                        image_hash = hashlib.sha1(data).hexdigest()
+                        self.connection.execute(
+                            'INSERT OR IGNORE INTO images (hash, data) '
+                            'VALUES (?, ?)', (image_hash, data))
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO sessions '
+                        '(user_id, image_hash, style, updated) '
+                        'VALUES (?, ?, ?, ?)',
+                        (user_id, image_hash, style, time.time()))
+                self.connection.execute(
+                    'DELETE FROM images WHERE hash NOT IN '
+                    '(SELECT image_hash FROM sessions '
+                    'WHERE image_hash IS NOT NULL)')
+
+    def load(self, user_id):
+        """Returns the stored session of the user or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT sessions.style, images.data FROM sessions '
+                'LEFT JOIN images ON images.hash = sessions.image_hash '
+                'WHERE sessions.user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        session = Session(user_id)
+        session.apply_style_record(row[0])
+        if row[1] is not None:
+            session.selected_image = BytesIO(row[1])
+        return session
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.connection.close()
+
+
+class SessionManager:
+    """Class that keeps the sessions of active users in memory.
+
+    Sessions of other users live in the store and are restored when
+    get is called for them. Sessions that are being written to the
+    store are kept in hibernating until the write is done, so a user
+    coming back mid-write gets the same session object back.
+    """
+
+    def __init__(self, store, idle_timeout=IDLE_TIMEOUT):
+        self.store = store
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.hibernating = {}
+
+    async def get(self, user_id, loop):
+        """Returns the session of the user, restoring or creating it.
+
+        Stored sessions are read in the default executor, as they can
+        hold images of several megabytes.
+        """
+        session = self.sessions.get(user_id) or self.hibernating.get(user_id)
+        if session is None:
+            session = await loop.run_in_executor(
+                None, self.store.load, user_id)
+            # Another command of the same user may have restored or
+            # created the session while it was being read.
+            session = (self.sessions.get(user_id) or session
+                       or Session(user_id))
+        self.sessions[user_id] = session
+        session.last_used = time.monotonic()
+        return session
+
+    async def hibernate_idle(self, loop):
+        """Hibernates every session idle for longer than the timeout.
+
+        The sessions are snapshotted on the event loop and written in
+        the default executor, so the SQLite writes never block the
+        loop. Returns the number of sessions hibernated.
+        """
+        now = time.monotonic()
+        idle = [
+            user_id for user_id, session in self.sessions.items()
+            if now - session.last_used > self.idle_timeout
+        ]
+        if not idle:
+            return 0
+        snapshots = []
+        for user_id in idle:
+            session = self.sessions.pop(user_id)
+            self.hibernating[user_id] = session
+            snapshots.append(session.snapshot())
+        try:
+            await loop.run_in_executor(None, self.store.save_all, snapshots)
+        finally:
+            for user_id in idle:
+                self.hibernating.pop(user_id, None)
+        return len(idle)
+
+    def hibernate_all(self):
+        """Writes every session to the store and drops them from memory.
+
+        Used on shutdown. Sessions of a batch that is still being
+        written are included, as the store may be closed before that
+        batch runs. A session that is in both keeps its active state.
+        """
+        pending = dict(self.hibernating, **self.sessions)
+        self.store.save_all(
+            [session.snapshot() for session in pending.values()])
+        self.sessions.clear()
+        self.hibernating.clear()
@@ -0,0 +1,45 @@
+"""Single-flight module.
+
+Contains a helper that coalesces concurrent calls for the same key into
+one in-flight call. Every caller that arrives while the call is running
+awaits the same result instead of starting its own.
+"""
+
+# Standard library imports
+import asyncio
+
+
+class SingleFlight:
+    """Class that runs at most one call per key at a time.
+
+    Callers await the returned future through asyncio.shield, so a
+    caller that is cancelled does not cancel the work the other callers
+    are waiting on.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def start(self, key, func):
+        """Returns the future of the call for key, starting it if needed.
+
+        func must be a function returning a coroutine. It is only called
+        if no call for key is currently in flight. The call is
+        registered before this returns, so callers that need to do
+        something only for new calls can check in_flight first without
+        racing each other.
+        """
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.started += 1
+            future = asyncio.ensure_future(func())
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        return future
+
+    def in_flight(self, key):
+        return key in self.calls
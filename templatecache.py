@@ -0,0 +1,240 @@
+"""Template cache module.
+
+Contains the code used to keep a warm local cache of meme templates.
+Top image posts are fetched from the subreddits in the config file
+through a pluggable fetcher, normalized, deduplicated by content hash
+and stored on disk together with a small JSON index. Searches are
+served from the index, so they never touch the network.
+"""
+
+# Standard library imports
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from io import BytesIO
+import aiohttp
+# PIL (Pillow) image editing library import
+from PIL import Image
+# Local module imports
+import ingest
+
+logger = logging.getLogger('discord')
+
+CACHE_DIR = 'templates'
+# Normalized templates are at most this wide or tall.
+TEMPLATE_SIZE = 1024
+MAX_TEMPLATES = 500
+MAX_CACHE_BYTES = 100 * 1024 * 1024
+POSTS_PER_SUBREDDIT = 25
+
+
+def read_subreddits(config):
+    """Returns the non-empty entries of the [Subreddit List] section."""
+    if not config.has_section('Subreddit List'):
+        return []
+    subreddits = []
+    for name in config['Subreddit List'].values():
+        name = name.strip().strip('/')
+        if name.startswith('r/'):
+            name = name[2:]
+        if name:
+            subreddits.append(name)
+    return subreddits
+
+
+class RedditFetcher:
+    """Class that fetches top image posts from reddit.
+
+    Any object with the same two coroutine methods can be used in its
+    place, for example a stand-in serving local files.
+    """
+
+    def __init__(self, period='day',
+                 base_url='https://www.reddit.com'):
+        self.period = period
+        self.base_url = base_url
+        self.headers = {'User-Agent': 'MemeMakerBot/1.0'}
+
+    async def fetch_posts(self, subreddit, limit):
+        """Returns a list of {'title', 'url', 'score'} image posts."""
+        url = f'{self.base_url}/r/{subreddit}/top.json'
+        params = {'t': self.period, 'limit': limit}
+        async with aiohttp.ClientSession(headers=self.headers) as session:
+            async with session.get(url, params=params) as response:
+                if response.status != 200:
+                    return []
+                listing = await response.json()
+        posts = []
+        for child in listing.get('data', {}).get('children', []):
+            post = child.get('data', {})
+            if post.get('over_18') or post.get('post_hint') != 'image':
+                continue
+            posts.append({
+                'title': post.get('title', ''),
+                'url': post.get('url', ''),
+                'score': post.get('score', 0),
+            })
+        return posts
+
+    async def fetch_image(self, url):
+        """Returns the image at url as a BytesIO object."""
+        return await ingest.fetch_image(url)
+
+
+def normalize_image(image_bytes):
+    """Returns the image as RGB jpeg bytes no larger than TEMPLATE_SIZE."""
+    with Image.open(image_bytes) as img:
+        img = img.convert('RGB')
+        img.thumbnail((TEMPLATE_SIZE, TEMPLATE_SIZE))
+        bytes_object = BytesIO()
+        img.save(bytes_object, format='jpeg', quality=90)
+    return bytes_object.getvalue()
+
+
+class TemplateCache:
+    """Class that defines the on-disk template cache.
+
+    Templates are stored as <sha1>.jpg files in the cache directory. The
+    index maps every hash to the post it came from and is kept in memory
+    and mirrored to index.json.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_templates=MAX_TEMPLATES,
+                 max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_templates = max_templates
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index = {}
+        self.seen_urls = set()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        """Loads the index file, dropping entries whose image is gone."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, encoding='utf-8') as index_file:
+            index = json.load(index_file)
+        self.index = {
+            digest: entry for digest, entry in index.items()
+            if os.path.exists(self.image_path(digest))
+        }
+        self.seen_urls = {entry['url'] for entry in self.index.values()}
+
+    def save_index(self):
+        """Writes the index file atomically."""
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temp_path, self.index_path)
+
+    def image_path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.jpg')
+
+    def write_image(self, image_data):
+        """Writes normalized image data to disk and returns its hash."""
+        digest = hashlib.sha1(image_data).hexdigest()
+        if not os.path.exists(self.image_path(digest)):
+            with open(self.image_path(digest), 'wb') as image_file:
+                image_file.write(image_data)
+        return digest
+
+    def add(self, post, subreddit, digest, image_data):
+        """Adds a written image to the index.
+
+        Returns False if the same image was already cached.
+        """
+        self.seen_urls.add(post['url'])
+        if digest in self.index:
+            return False
+        self.index[digest] = {
+            'title': post['title'],
+            'url': post['url'],
+            'score': post.get('score', 0),
+            'subreddit': subreddit,
+            'size': len(image_data),
+            'added': time.time(),
+        }
+        return True
+
+    def evict(self):
+        """Removes the oldest templates until the cache is within limits."""
+        total = sum(entry['size'] for entry in self.index.values())
+        oldest_first = sorted(self.index, key=lambda d: self.index[d]['added'])
+        for digest in oldest_first:
+            if (len(self.index) <= self.max_templates
+                    and total <= self.max_bytes):
+                break
+            total -= self.index.pop(digest)['size']
+            try:
+                os.remove(self.image_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def search(self, query, limit=5):
+        """Returns up to limit (digest, entry) pairs matching the query.
+
+        Templates are ranked by the number of query words in their title
+        and then by their score.
+        """
+        words = query.lower().split()
+        matches = []
+        for digest, entry in self.index.items():
+            title = entry['title'].lower()
+            hits = sum(1 for word in words if word in title)
+            if hits:
+                matches.append((hits, entry['score'], digest))
+        matches.sort(reverse=True)
+        return [(digest, self.index[digest])
+                for _, _, digest in matches[:limit]]
+
+    def load(self, digest):
+        """Returns the cached template image as a BytesIO object."""
+        with open(self.image_path(digest), 'rb') as image_file:
+            return BytesIO(image_file.read())
+
+
+async def refresh(cache, fetcher, subreddits, loop,
+                  limit=POSTS_PER_SUBREDDIT):
+    """Fetches new top posts from every subreddit into the cache.
+
+    Decoding, normalizing and writing the images is done in the default
+    executor so the event loop is never blocked. The index itself is
+    only changed on the event loop. Returns the number of templates
+    added.
+    """
+    added = 0
+    for subreddit in subreddits:
+        try:
+            posts = await fetcher.fetch_posts(subreddit, limit)
+        except Exception:
+            # One unreachable, slow or malformed subreddit listing does
+            # not end the refresh
+            logger.warning('Skipped r/%s while refreshing templates.',
+                           subreddit, exc_info=True)
+            continue
+        for post in posts:
+            if post['url'] in cache.seen_urls:
+                continue
+            try:
+                image_bytes = await fetcher.fetch_image(post['url'])
+                image_data = await loop.run_in_executor(
+                    None, normalize_image, image_bytes)
+                digest = await loop.run_in_executor(
+                    None, cache.write_image, image_data)
+            except asyncio.TimeoutError:
+                # A timeout may be temporary, so the post is retried on
+                # the next refresh.
+                continue
+            except (ingest.IngestError, aiohttp.ClientError, OSError):
+                cache.seen_urls.add(post['url'])
+                continue
+            if cache.add(post, subreddit, digest, image_data):
+                added += 1
+    cache.evict()
+    cache.save_index()
+    return added